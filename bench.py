@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the declaration tree and comment assignment over a synthetic header.
+# The header is a namespace with N documented free functions and a class with N documented methods.
+
+import os
+import time
+import tempfile
+from clang.cindex import Index, TranslationUnit, File
+from comments import get_file_extent, create_decls, create_comments, create_decl_tree, assign_comments
+
+def synthetic_header( count ):
+    lines = [ '/// A huge namespace', 'namespace huge', '{' ]
+    for i in range( count ):
+        lines.append( f'/// Function number {i}' )
+        lines.append( f'int function{i}( int a, int b );' )
+    lines.append( '' )
+    lines.append( '/// A huge class' )
+    lines.append( 'class Huge' )
+    lines.append( '{' )
+    lines.append( 'public:' )
+    for i in range( count ):
+        lines.append( f'    int method{i}( int x ); ///< Method number {i}' )
+    lines.append( '};' )
+    lines.append( '}' )
+    return '\n'.join( lines ) + '\n'
+
+def run( count, repeat ):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join( tmp, 'huge.h' )
+        with open( filename, 'w' ) as f:
+            f.write( synthetic_header( count ) )
+        tu = Index.create().parse( filename, [ '-x', 'c++' ], options = TranslationUnit.PARSE_SKIP_FUNCTION_BODIES )
+        extent = get_file_extent( tu, File.from_name( tu, filename ) )
+        decls = create_decls( tu, { filename: extent } )[filename]
+        ( comments, groups ) = create_comments( list( tu.get_tokens( extent = extent ) ), filename )
+
+        tree_time = 0
+        assign_time = 0
+        for i in range( repeat ):
+            start = time.perf_counter()
+            tree = create_decl_tree( decls + groups )
+            tree_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            assign_comments( tree, comments )
+            assign_time += time.perf_counter() - start
+        return ( len( decls ), len( comments ), tree_time / repeat, assign_time / repeat )
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="counts",
+                      help="Number of functions (and methods) in the header, can be repeated",
+                      metavar="N", type=int, action="append", default=None)
+    parser.add_option("-r", "--repeat", dest="repeat",
+                      help="Average over N runs",
+                      metavar="N", type=int, default=3)
+    ( opts, args ) = parser.parse_args()
+
+    print( f'{"decls":>8} {"comments":>8} {"tree (s)":>10} {"assign (s)":>10}' )
+    for count in opts.counts or [ 1000, 2000, 4000, 8000 ]:
+        ( decls, comments, tree_time, assign_time ) = run( count, opts.repeat )
+        print( f'{decls:>8} {comments:>8} {tree_time:>10.4f} {assign_time:>10.4f}' )
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,31 @@
 import re
 import markdown
 import html
+import hashlib
+from collections import OrderedDict
+from diagrams import CachedBlockdiagExtension
 from functools import reduce
 from pprint import pprint 
 
 htmlTypes = [ 'global', 'class', 'struct', 'namespace' ]
 
+# Part of the key of the converted comments, change it when the conversion changes
+# so the HTML kept in databases by previous builds is not used anymore.
+cache_version = 1
+
+def comment_hash( cmts, pygments = False ):
+    text = f'{cache_version}\n{markdown.__version__}\n{pygments}\n{cmts}'
+    return hashlib.sha1( text.encode() ).hexdigest()
+
+# Keys of the converted comments worth keeping: every comment, with and without pygments.
+def comment_hashes( comments ):
+    result = set()
+    for cmts in comments:
+        if cmts:
+            result.add( comment_hash( cmts, False ) )
+            result.add( comment_hash( cmts, True ) )
+    return result
+
 doxy_class = re.compile( r'[\s]*@class .*' )
 doxy_brief = re.compile( r'[\s]*@brief(.*)' )
 doxy_return = re.compile( r'[\s]*@return(.*)' )
@@ -49,19 +69,34 @@ def doxy_filter( lines ):
         result.append( line )
     return result
 
+# Converts comments to HTML. Conversions are kept in an LRU cache of cache_size entries keyed
+# by the hash of the comment. store, an object with comment_html( key ) and save_comment_html( rows )
+# methods like CPPDatabase, is looked up before converting a comment; with save the new
+# conversions are added to it by flush() to reuse them in the next builds.
 class Cleanup:
-    def __init__( self ):
+    # Diagrams are drawn again for every build unless diagram_cache, a directory, is given.
+    # With pygments, code blocks are highlighted while converting instead of by the browser.
+    def __init__( self, cache_size = 4096, store = None, diagram_cache = None, save = False, pygments = False ):
+        self.pygments = pygments
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.store = store
+        self.save = save
+        self.pending = []
         self.header = re.compile( r'[\s]*([^:]*)[:][\s]*' )
         self.definition = re.compile( r'[\s]*((?!=>).+)=>(.*)' )
         configs = {
             'markdown_blockdiag': { 'format': 'svg' },
-            'pymdownx.highlight': { 'use_pygments': False },
+            'pymdownx.highlight': { 'use_pygments': pygments },
         }
+        blockdiag = 'markdown_blockdiag'
+        if diagram_cache:
+            blockdiag = CachedBlockdiagExtension( diagram_cache, **configs.pop( 'markdown_blockdiag' ) )
         self.md = markdown.Markdown( extensions = [
                 'def_list',
                 'admonition',
                 'mdx_outline',
-                'markdown_blockdiag',
+                blockdiag,
                 'pymdownx.details',
                 'pymdownx.arithmatex',
                 'pymdownx.superfences',
@@ -72,6 +107,27 @@ class Cleanup:
     def __call__( cleaner, cmts ):
         if cmts == '':
             return cmts
+        key = comment_hash( cmts, cleaner.pygments )
+        if key in cleaner.cache:
+            cleaner.cache.move_to_end( key )
+            return cleaner.cache[key]
+        mdhtml = cleaner.store.comment_html( key ) if cleaner.store else None
+        if mdhtml == None:
+            mdhtml = cleaner.convert( cmts )
+            if cleaner.save:
+                cleaner.pending.append( ( key, mdhtml ) )
+        cleaner.cache[key] = mdhtml
+        if len( cleaner.cache ) > cleaner.cache_size:
+            cleaner.cache.popitem( last = False )
+        return mdhtml
+
+    # Save the new conversions in the store, to call inside a transaction.
+    def flush( cleaner ):
+        if cleaner.pending:
+            cleaner.store.save_comment_html( cleaner.pending )
+            cleaner.pending = []
+
+    def convert( cleaner, cmts ):
         clean = cleaner.cleanup_comments( cmts.splitlines() )
         doxy = doxy_filter( clean )
         mdown = cleaner.convert_to_markdown( doxy )
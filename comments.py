@@ -2,11 +2,13 @@
 
 import pathlib
 import re
-import copy
+import bisect
+import weakref
+from ctypes import c_void_p, c_size_t, POINTER, byref
 from pprint import pprint
 from decl_node import decl_node, decl_location
 from node_type import cursor_to_type
-from clang.cindex import Index, Cursor, CursorKind, TokenKind, TranslationUnit, SourceLocation, SourceRange, FileInclusion, File, Token, AccessSpecifier
+from clang.cindex import Index, Cursor, CursorKind, TokenKind, TranslationUnit, SourceLocation, SourceRange, FileInclusion, File, Token, AccessSpecifier, conf
 
 Cursor.__hash__ = lambda c: c.hash
 
@@ -113,7 +115,23 @@ def path_from_location( location ):
             path_cache[filename] = result
     return result
 
-def get_file_extent( tu, filename ):
+global extent_cache
+extent_cache = weakref.WeakKeyDictionary()
+
+# clang_getFileContents is not wrapped by the python bindings.
+def file_size( tu, file ):
+    try:
+        fn = conf.lib.clang_getFileContents
+    except AttributeError:
+        return None
+    fn.argtypes = [ c_void_p, c_void_p, POINTER( c_size_t ) ]
+    fn.restype = c_void_p
+    size = c_size_t()
+    if fn( tu, file, byref( size ) ) == None:
+        return None
+    return size.value
+
+def search_file_end( tu, filename ):
     def srcloc( size ):
         result = SourceLocation.from_offset( tu, filename, size )
         if str( result.file ) != str( filename ):
@@ -133,9 +151,20 @@ def get_file_extent( tu, filename ):
             small = mid
         else:
             large = mid
-    end = srcloc( small )
-    start = srcloc( 0 )
-    return SourceRange.from_locations( start, end )
+    return small
+
+# The extent of a whole file, memoized per translation unit.
+def get_file_extent( tu, filename ):
+    global extent_cache
+    extents = extent_cache.setdefault( tu, {} )
+    if str( filename ) not in extents:
+        size = file_size( tu, filename )
+        if size == None:
+            size = search_file_end( tu, filename )
+        start = SourceLocation.from_offset( tu, filename, 0 )
+        end = SourceLocation.from_offset( tu, filename, size )
+        extents[str( filename )] = SourceRange.from_locations( start, end )
+    return extents[str( filename )]
 
 def path_from_include( include ):
     result = None
@@ -188,29 +217,46 @@ ignore_kinds = [
     CursorKind.CXX_OVERRIDE_ATTR,
 ]
 
-def create_decls( cursor, topfile, extent, parent = None ):
-    lst = []
-    if cursor.location.file != None and str( cursor.location.file ) != topfile:
-        return lst
-    k = cursor.kind
-
-    if k in decl_kinds:
-        if k == CursorKind.TRANSLATION_UNIT:
-            cursor = FakeCursor( cursor, extent )
-        elif k == CursorKind.TEMPLATE_TYPE_PARAMETER and k == CursorKind.TEMPLATE_NON_TYPE_PARAMETER and cursor.semantic_parent.kind == CursorKind.TRANSLATION_UNIT:
-            cursor = FakeCursor( cursor, extent, parent )
-        lst.append( cursor )
-    elif k in ignore_kinds:
-        pass
-    elif k.is_expression():
-        pass
-    else:
-        print( "UNKNOWN KIND: " + cursor.kind.name + ' (' + ' '.join( [x.spelling for x in cursor.get_tokens()] ) + ')' )
-
-    if cursor.kind not in decl_skip_children:
-        for c in cursor.get_children():
-            lst += create_decls( c, topfile, extent, cursor )
-    return lst
+# Walk the translation unit once, sorting the declarations by the file they are in.
+# extents maps every file to document to its extent; the result maps it to its decls.
+# Like before, children are only visited while they are in the same file as their parent.
+def create_decls( tu, extents ):
+    decls = {}
+
+    def visit( cursor, topfile, parent ):
+        lst = decls[topfile]
+        k = cursor.kind
+
+        if k in decl_kinds:
+            if k == CursorKind.TEMPLATE_TYPE_PARAMETER and k == CursorKind.TEMPLATE_NON_TYPE_PARAMETER and cursor.semantic_parent.kind == CursorKind.TRANSLATION_UNIT:
+                cursor = FakeCursor( cursor, extents[topfile], parent )
+            lst.append( cursor )
+        elif k in ignore_kinds:
+            pass
+        elif k.is_expression() or k.is_statement():
+            pass
+        else:
+            print( "UNKNOWN KIND: " + cursor.kind.name + ' (' + ' '.join( [x.spelling for x in cursor.get_tokens()] ) + ')' )
+
+        if cursor.kind not in decl_skip_children:
+            for c in cursor.get_children():
+                f = c.location.file
+                if f == None or str( f ) == topfile:
+                    visit( c, topfile, cursor )
+
+    tops = {}
+    for ( filename, extent ) in extents.items():
+        tops[filename] = FakeCursor( tu.cursor, extent )
+        decls[filename] = [ tops[filename] ]
+
+    for c in tu.cursor.get_children():
+        f = c.location.file
+        if f == None:
+            for filename in extents:
+                visit( c, filename, tops[filename] )
+        elif str( f ) in decls:
+            visit( c, str( f ), tops[str( f )] )
+    return decls
 
 c_comment_start = re.compile( r'/[*]+([!]?[!<]?)(.*)' )
 c_comment_cont = re.compile( r'[\s]*[*](.*)' )
@@ -303,10 +349,22 @@ def assign_parent_to_groups( tree, parent ):
         if isinstance( cursor, FakeToken ):
             cursor.semantic_parent = parent.canonical
 
+# Build the tree from the decls sorted by extent (start first, then the largest first),
+# so every decl is nested in the closest open decl that contains it.
 def create_decl_tree( decls ):
     lst = []
-    for cursor in decls:
-        insert_decl_tree( cursor, lst )
+    stack = []
+    ranges = [ ( cursor.extent.start.offset, -cursor.extent.end.offset, i ) for ( i, cursor ) in enumerate( decls ) ]
+    for ( start, end, i ) in sorted( ranges ):
+        end = -end
+        while stack and not range_contains( stack[-1][0], ( start, end ) ):
+            stack.pop()
+        item = ( decls[i], [] )
+        if stack:
+            stack[-1][1].append( item )
+        else:
+            lst.append( item )
+        stack.append( ( ( start, end ), item[1] ) )
     assign_parent_to_groups( lst, None )
     return lst
 
@@ -463,25 +521,41 @@ def range_contains_loc( rng, loc ):
         return True
     return False
 
-def find_following_decl( parent, decls, loc ):
-    for ( cursor, children ) in decls:
-        name = cursor
-        rng = ( cursor.extent.start.offset, cursor.extent.end.offset )
-        if loc < rng[0]:
-            return name
-        elif loc < rng[1]:
-            return find_following_decl( name, children, loc )
-    return parent
-
-def find_preceding_decl( parent, decls, loc ):
-    for ( cursor, children ) in reversed( decls ):
-        name = cursor
-        rng = ( cursor.extent.start.offset, cursor.extent.end.offset )
-        if loc > rng[1]:
-            return name
-        elif loc > rng[0]:
-            return find_preceding_decl( name, children, loc )
-    return parent
+# Start and end offsets of one level of the decl tree, to bisect them.
+# Siblings never overlap, so both lists are sorted.
+def level_offsets( decls, levels ):
+    key = id( decls )
+    if key not in levels:
+        starts = [ cursor.extent.start.offset for ( cursor, children ) in decls ]
+        ends = [ cursor.extent.end.offset for ( cursor, children ) in decls ]
+        levels[key] = ( starts, ends )
+    return levels[key]
+
+def find_following_decl( parent, decls, loc, levels = None ):
+    if levels == None:
+        levels = {}
+    ( starts, ends ) = level_offsets( decls, levels )
+    # First decl ending after loc
+    i = bisect.bisect_right( ends, loc )
+    if i == len( decls ):
+        return parent
+    ( cursor, children ) = decls[i]
+    if loc < starts[i]:
+        return cursor
+    return find_following_decl( cursor, children, loc, levels )
+
+def find_preceding_decl( parent, decls, loc, levels = None ):
+    if levels == None:
+        levels = {}
+    ( starts, ends ) = level_offsets( decls, levels )
+    # Last decl starting before loc
+    i = bisect.bisect_left( starts, loc ) - 1
+    if i < 0:
+        return parent
+    ( cursor, children ) = decls[i]
+    if loc > ends[i]:
+        return cursor
+    return find_preceding_decl( cursor, children, loc, levels )
 
 def convert_to_nodes( decls, comments ):
     def cnvt_nodes( nodes, parent ):
@@ -502,15 +576,18 @@ def convert_to_nodes( decls, comments ):
     result = cnvt_nodes( decls, { 'key': [], 'link': '' } )
     return result
     
-def assign_comments( decls, comments, mapping = {} ):
+def assign_comments( decls, comments, mapping = {}, owners = {} ):
     result = {}
     top = decls[0][0]
+    levels = {}
     for ( tag, cmt, loc ) in comments:
         decl = top
-        if tag == '!<' or tag == '<':
-            decl = find_preceding_decl( top, decls, loc )
+        if loc in owners:
+            decl = owners[loc]
+        elif tag == '!<' or tag == '<':
+            decl = find_preceding_decl( top, decls, loc, levels )
         else:
-            decl = find_following_decl( top, decls, loc )
+            decl = find_following_decl( top, decls, loc, levels )
         key = decl.canonical
         lst = result.get( key, [] )
         lst.append( cmt )
@@ -531,19 +608,6 @@ def merge( master, more ):
         cmts += comments
         master[name] = cmts
 
-def merge_decl_tree( master, tree ):
-    for node in tree:
-        inmaster = next( filter( lambda x: x['name'] == node['name'], master ), None )
-        if inmaster:
-            #print( "MERGING " + inmaster['kind'] + ' ' + inmaster['name'] + ' ' + str(len( node['children'] ) )
-            inmaster['comments'] += node['comments']
-            inmaster['location'] += node['location']
-            merge_decl_tree( inmaster['children'], node['children'] )
-        else:
-            inmaster = copy.deepcopy( node )
-            #print( "APPENDING " + inmaster['kind'] + ' ' + inmaster['name'] )
-            master.append( inmaster )
-
 def dump_tree( tree, indent = 0 ):
     tabs = '  ' * indent
     for ( cursor, children ) in tree:
@@ -555,82 +619,143 @@ def dump_decl( decl ):
     ext = ( decl.extent.start.offset, decl.extent.end.offset )
     pprint( ( decl.spelling, ext ) )
 
-def gather_comments( tu, files ):
-    decl_cmts_list = []
-    parents = {}
-    for filename in files:
-        print( "========== " + filename )
-        file_extent = get_file_extent( tu, File.from_name( tu, filename ) )
-
-        # decl_list is a list of pairs ( cursor, extent )
-        # extent is a pair of numbers ( start offset, end offset )
-        decl_list = create_decls( tu.cursor, filename, file_extent )
-        #print( "DECL_LIST" )
-        #for item in decl_list:
-        #    dump_decl( item )
-        #print( '----------' )
-
-        # Comments is a list of pairs ( comment, location )
-        # location is an integer offset.
-        # Groups is a list of group comments (FakeTokens)
-        tokens = tu.get_tokens( extent = file_extent )
-        ( comments, groups ) = create_comments( tokens, filename )
-        #print( "COMMENTS" )
-        #for c in comments:
-        #    pprint( c )
-        #print( '----------' )
-        #print( "GROUPS" )
-        #for g in groups:
-        #    pprint( g )
-        #print( '----------' )
-
-        # Group comments are added to the decl_list.
-        # That way, groups can have comments just like declarations.
-        for g in groups:
-            decl_list.append( g )
-        #print( "DECL_LIST + GROUPS" )
-        #for item in decl_list:
-        #    dump_decl( item )
-        #print( '----------' )
-
-        # Create a tree of declarations (including groups).
-        # The tree is created from the extents of each declaration/group.
-        tree = create_decl_tree( decl_list )
-        #print( "DECL_TREE" )
-        #dump_tree( tree )
-        #print( '----------' )
-
-        # Assign comments to declarations
-        # This is done based on the extent of the decls/groups and the location of comments.
-        # decl_cmts is a dictionary of cursor/token -> list of comments
-        # A cursor means a declaration, a token for groups.
-        decl_cmts = assign_comments( tree, comments )
-        #print( "DECL_CMTS" )
-        #for item in decl_cmts.items():
-        #    pprint( ( sem_name( item[0] ), item[1] ) )
-        #print( '----------' )
-
-        access_comments = set( [c for c in decl_cmts if c.kind == CursorKind.CXX_ACCESS_SPEC_DECL] )
-        #print( "ACCESS_COMMENTS", len( access_comments ) )
-        tree = remove_unused_access( tree, set( access_comments ) )
-
-        tree = group_childrens( tree )
-        #print( "DECL_TREE GROUPED" )
-        #dump_tree( tree )
-        #print( '----------' )
-
-        # Assign comments to declarations
-        decl_cmts = convert_to_nodes( tree, decl_cmts )
-        #print( "DECL_CMTS as NODES" )
-        #pprint( decl_cmts, sort_dicts=False )
-        #print( '----------' )
-
-        # Finally add all of the decl_cmts2 into the final list
-        merge_decl_tree( decl_cmts_list, decl_cmts )
-
-    #print( "DECL_CMTS_LIST" )
-    #pprint( decl_cmts_list, sort_dicts=False )
+function_kinds = [
+    CursorKind.CXX_METHOD,
+    CursorKind.CONSTRUCTOR,
+    CursorKind.DESTRUCTOR,
+    CursorKind.CONVERSION_FUNCTION,
+    CursorKind.FUNCTION_DECL,
+    CursorKind.FUNCTION_TEMPLATE,
+]
+
+# Find the ( start, end, cursor ) of the function bodies of decls in tokens.
+# When parsing with PARSE_SKIP_FUNCTION_BODIES the extent of a function stops after its
+# declarator, so the body is the '{' right after it (or after the constructor initializer list).
+def function_bodies( decls, tokens ):
+    tokens = [ t for t in tokens if t.kind != TokenKind.COMMENT ]
+    offsets = [ t.location.offset for t in tokens ]
+    matching = {}
+    stack = []
+    for ( i, tok ) in enumerate( tokens ):
+        if tok.kind == TokenKind.PUNCTUATION:
+            if tok.spelling == '{':
+                stack.append( i )
+            elif tok.spelling == '}' and stack:
+                matching[stack.pop()] = i
+
+    bodies = []
+    for cursor in decls:
+        if cursor.kind not in function_kinds:
+            continue
+        i = bisect.bisect_left( offsets, cursor.extent.end.offset )
+        if i < len( tokens ) and tokens[i].spelling == ':':
+            # Skip the initializer list, a brace only starts the body after ')' or '}'
+            i += 1
+            depth = 0
+            while i < len( tokens ):
+                t = tokens[i].spelling
+                if t == '(':
+                    depth += 1
+                elif t == ')':
+                    depth -= 1
+                elif t == '{':
+                    if depth == 0 and tokens[i - 1].spelling in [ ')', '}' ]:
+                        break
+                    i = matching.get( i, i )
+                elif t == ';':
+                    break
+                i += 1
+        if i < len( tokens ) and tokens[i].spelling == '{' and i in matching:
+            bodies.append( ( offsets[i], tokens[matching[i]].extent.end.offset, cursor ) )
+    bodies.sort( key = lambda b: b[0] )
+    return bodies
+
+# Map the location of the comments inside bodies to the function owning the body.
+def body_owners( comments, bodies ):
+    starts = [ b[0] for b in bodies ]
+    result = {}
+    for cmt in comments:
+        i = bisect.bisect_right( starts, cmt[2] ) - 1
+        if i >= 0 and cmt[2] < bodies[i][1]:
+            result[cmt[2]] = bodies[i][2]
+    return result
+
+# decl_list is the list of declarations in filename, as sorted by create_decls.
+def gather_file_comments( tu, filename, decl_list, skip_bodies = False ):
+    print( "========== " + filename )
+    file_extent = get_file_extent( tu, File.from_name( tu, filename ) )
+
+    #print( "DECL_LIST" )
+    #for item in decl_list:
+    #    dump_decl( item )
+    #print( '----------' )
+
+    # Comments is a list of pairs ( comment, location )
+    # location is an integer offset.
+    # Groups is a list of group comments (FakeTokens)
+    tokens = list( tu.get_tokens( extent = file_extent ) )
+    ( comments, groups ) = create_comments( tokens, filename )
+
+    # Without bodies, comments inside them would end up on the next declaration,
+    # they go to the function owning the body like when the bodies are parsed.
+    owners = {}
+    if skip_bodies:
+        owners = body_owners( comments, function_bodies( decl_list, tokens ) )
+    #print( "COMMENTS" )
+    #for c in comments:
+    #    pprint( c )
+    #print( '----------' )
+    #print( "GROUPS" )
+    #for g in groups:
+    #    pprint( g )
+    #print( '----------' )
+
+    # Group comments are added to the decl_list.
+    # That way, groups can have comments just like declarations.
+    for g in groups:
+        decl_list.append( g )
+    #print( "DECL_LIST + GROUPS" )
+    #for item in decl_list:
+    #    dump_decl( item )
     #print( '----------' )
 
-    return decl_cmts_list
+    # Create a tree of declarations (including groups).
+    # The tree is created from the extents of each declaration/group.
+    tree = create_decl_tree( decl_list )
+    #print( "DECL_TREE" )
+    #dump_tree( tree )
+    #print( '----------' )
+
+    # Assign comments to declarations
+    # This is done based on the extent of the decls/groups and the location of comments.
+    # decl_cmts is a dictionary of cursor/token -> list of comments
+    # A cursor means a declaration, a token for groups.
+    decl_cmts = assign_comments( tree, comments, owners = owners )
+    #print( "DECL_CMTS" )
+    #for item in decl_cmts.items():
+    #    pprint( ( sem_name( item[0] ), item[1] ) )
+    #print( '----------' )
+
+    access_comments = set( [c for c in decl_cmts if c.kind == CursorKind.CXX_ACCESS_SPEC_DECL] )
+    #print( "ACCESS_COMMENTS", len( access_comments ) )
+    tree = remove_unused_access( tree, set( access_comments ) )
+
+    tree = group_childrens( tree )
+    #print( "DECL_TREE GROUPED" )
+    #dump_tree( tree )
+    #print( '----------' )
+
+    # Assign comments to declarations
+    decl_cmts = convert_to_nodes( tree, decl_cmts )
+    #print( "DECL_CMTS as NODES" )
+    #pprint( decl_cmts, sort_dicts=False )
+    #print( '----------' )
+
+    return decl_cmts
+
+# Returns a list of ( filename, node tree ) for each of the files.
+def gather_files( tu, files, skip_bodies = False ):
+    extents = { filename: get_file_extent( tu, File.from_name( tu, filename ) ) for filename in files }
+    decls = create_decls( tu, extents )
+    return [ ( filename, gather_file_comments( tu, filename, decls[filename], skip_bodies ) ) for filename in extents ]
 
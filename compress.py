@@ -0,0 +1,120 @@
+import os
+import re
+import stat
+import gzip
+import hashlib
+import tempfile
+from pathlib import Path
+from multiprocessing import Pool
+
+# Output stage of gendoc: minified pages and precompressed siblings ( page.html.gz, page.html.br )
+# for static servers able to send them as they are.
+
+# Whitespace is kept as it is inside these elements.
+protected = re.compile( r'<(pre|script|style|textarea)\b.*?</\1\s*>', re.S | re.I )
+html_comment = re.compile( r'<!--(?!\[if).*?-->', re.S )
+whitespace = re.compile( r'\s+' )
+
+def collapse( text ):
+    text = html_comment.sub( '', text )
+    return whitespace.sub( lambda m: '\n' if '\n' in m.group( 0 ) else ' ', text )
+
+# Remove the comments, the indentation and the runs of blanks outside preformatted elements.
+def minify_html( text ):
+    result = []
+    last = 0
+    for m in protected.finditer( text ):
+        result.append( collapse( text[last:m.start()] ) )
+        result.append( m.group( 0 ) )
+        last = m.end()
+    result.append( collapse( text[last:] ) )
+    return ''.join( result )
+
+compressed_suffixes = [ '.html', '.json', '.css', '.js', '.svg', '.txt' ]
+
+def gzip_data( data ):
+    return gzip.compress( data, compresslevel = 9, mtime = 0 )
+
+def brotli_data( data ):
+    # Optional dependency, only needed for .br files.
+    import brotli
+    return brotli.compress( data, quality = 11 )
+
+compressors = {
+    'gz': gzip_data,
+    'br': brotli_data,
+}
+
+# mkstemp creates the file readable by its owner only, the final file gets mode instead.
+def write_atomic( filename, data, mode ):
+    ( fd, tmp ) = tempfile.mkstemp( dir = filename.parent )
+    with os.fdopen( fd, 'wb' ) as f:
+        f.write( data )
+    os.chmod( tmp, mode )
+    os.replace( tmp, filename )
+
+# Whether filename exists with mode.
+def same_mode( filename, mode ):
+    try:
+        return stat.S_IMODE( os.stat( filename ).st_mode ) == mode
+    except OSError:
+        return False
+
+# Write the compressed siblings of a file, unless its content did not change since they were
+# written. Siblings get the permissions of the file. Returns ( file, content hash, whether siblings were written ).
+def compress_file( job ):
+    ( filename, previous, formats ) = job
+    data = filename.read_bytes()
+    mode = stat.S_IMODE( os.stat( filename ).st_mode )
+    digest = hashlib.sha1( data ).hexdigest()
+    siblings = [ ( Path( str( filename ) + '.' + fmt ), fmt ) for fmt in formats ]
+    if digest == previous and all( [ same_mode( sibling, mode ) for ( sibling, fmt ) in siblings ] ):
+        return ( filename, digest, False )
+    for ( sibling, fmt ) in siblings:
+        write_atomic( sibling, compressors[fmt]( data ), mode )
+    return ( filename, digest, True )
+
+# Remove the compressed siblings in formats of the files named by their path in the site.
+def remove_siblings( topdir, names, formats ):
+    for name in names:
+        for fmt in formats:
+            ( Path( topdir ) / ( name + '.' + fmt ) ).unlink( missing_ok = True )
+
+# Compress every text file of the site directory in formats ( 'gz', 'br' ), with jobs processes.
+# previous holds the content hashes of the files compressed by the previous build, keyed by
+# their path in the site; returns the hashes of this build and the number of files compressed.
+# With rebuild every file is compressed again. Only the siblings of previous files that are
+# gone, or in formats not asked for anymore, are removed; other compressed files in the site are left alone.
+def compress_site( topdir, formats, previous = {}, jobs = 1, rebuild = False ):
+    for fmt in formats:
+        if fmt not in compressors:
+            raise Exception( f'unknown compression format {fmt}, expected one of {", ".join( compressors )}' )
+    if 'br' in formats:
+        # Fail before compressing anything when brotli is missing.
+        try:
+            import brotli
+        except ImportError:
+            raise Exception( 'the brotli package is needed to write .br files' )
+
+    topdir = Path( topdir )
+    files = []
+    for path in sorted( topdir.rglob( '*' ) ):
+        if path.suffix in compressed_suffixes and path.is_file():
+            files.append( path )
+    current = set( [ path.relative_to( topdir ).as_posix() for path in files ] )
+    remove_siblings( topdir, [ name for name in previous if name not in current ], compressors )
+    remove_siblings( topdir, [ name for name in previous if name in current ], [ fmt for fmt in compressors if fmt not in formats ] )
+
+    jobs_list = [ ( path, None if rebuild else previous.get( path.relative_to( topdir ).as_posix(), None ), formats ) for path in files ]
+    if jobs > 1:
+        with Pool( jobs ) as pool:
+            results = list( pool.imap_unordered( compress_file, jobs_list, 16 ) )
+    else:
+        results = map( compress_file, jobs_list )
+
+    hashes = {}
+    written = 0
+    for ( path, digest, compressed ) in results:
+        hashes[path.relative_to( topdir ).as_posix()] = digest
+        written += compressed
+    return ( hashes, written )
@@ -1,19 +1,161 @@
 
 import sqlite3
+import time
+from contextlib import contextmanager
 from pprint import pprint
 
+def node_link( node ):
+    link = node['link']
+    if '#' in link:
+        link = link.replace( '#', '.html#' )
+    elif '?' in link:
+        link = link.replace( '?', '.html?' )
+    else:
+        link = link + '.html'
+    return link
+
+# Flatten a node tree into ( name, kind, key, link, parent, decl, comments ) rows.
+def node_rows( nodes ):
+    for node in nodes:
+        skip = node['name'] == ''
+        if node.get( 'access', 'public' ) == 'private':
+            if len( node['comments'] ) == 0:
+                skip = True
+        if not skip:
+            yield ( node['name'], node['kind'], '/'.join( node['key'] ), node_link( node ),
+                '/'.join( node['key'][:-1] ), node['decl'], '\n'.join( node['comments'] ) )
+        yield from node_rows( node['children'] )
+
+# Stored in PRAGMA user_version, see CPPDatabase.migrate().
+schema_version = 1
+
 class CPPDatabase:
-    def __init__( self, dbfile ):
-        self.connection = sqlite3.connect( dbfile )
+    # Transactions are explicit, see transaction().
+    # With shared set, several processes can write to the same database: writers
+    # wait for each other for up to lock_timeout seconds instead of failing.
+    def __init__( self, dbfile, fast = False, shared = False, lock_timeout = 600 ):
+        self.connection = sqlite3.connect( dbfile, isolation_level = None, timeout = 5 )
         self.cursor = self.connection.cursor()
-        self.create_tables()
+        self.rows = 0
+        self.load_time = 0
+        self.lock_timeout = lock_timeout
+        if shared:
+            self.shared()
+        if fast:
+            self.fast_load()
+        with self.transaction():
+            self.migrate()
 
     def close( self ):
-        self.connection.commit()
         self.connection.close()
 
+    # Pragmas to load lots of records quickly. With synchronous off a crash
+    # in the middle of the load can corrupt the database, which is then built again.
+    def fast_load( self, cache_mb = 256 ):
+        self.cursor.execute( 'PRAGMA journal_mode = WAL;' )
+        self.cursor.execute( 'PRAGMA synchronous = OFF;' )
+        self.cursor.execute( f'PRAGMA cache_size = -{cache_mb * 1024};' )
+        self.cursor.execute( 'PRAGMA temp_store = MEMORY;' )
+
+    # Readers never block the writer in WAL mode, and the writer lock is waited for in begin().
+    def shared( self ):
+        self.cursor.execute( 'PRAGMA journal_mode = WAL;' )
+
+    # Take the write lock up front, so a transaction never fails half way because
+    # another process started writing. Retried until lock_timeout while the database is locked.
+    def begin( self ):
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.05
+        while True:
+            try:
+                self.cursor.execute( 'BEGIN IMMEDIATE;' )
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str( e ) or time.monotonic() > deadline:
+                    raise
+            time.sleep( delay )
+            delay = min( delay * 2, 1 )
+
+    @contextmanager
+    def transaction( self ):
+        start = time.perf_counter()
+        self.begin()
+        try:
+            yield
+        except:
+            self.cursor.execute( 'ROLLBACK;' )
+            raise
+        self.cursor.execute( 'COMMIT;' )
+        self.load_time += time.perf_counter() - start
+
+    def insert_rows( self, sql, rows ):
+        self.cursor.executemany( sql, rows )
+        self.rows += max( 0, self.cursor.rowcount )
+
+    def report( self ):
+        if self.load_time > 0:
+            print( f'wrote {self.rows} rows in {self.load_time:.2f}s ({self.rows / self.load_time:.0f} rows/s)' )
+
+    # Bring the tables of an existing database to the current schema version.
+    def migrate( self ):
+        version = self.cursor.execute( 'PRAGMA user_version;' ).fetchone()[0]
+        if version > schema_version:
+            raise Exception( f'database schema version {version} is newer than the supported version {schema_version}' )
+        if version < 1 and self.has_table( 'nodes' ):
+            # Version 0 stored the kind names in nodes and had neither a primary key nor indexes.
+            self.cursor.execute( 'ALTER TABLE nodes RENAME TO nodes_v0;' )
+            self.create_tables()
+            self.cursor.execute( 'INSERT OR IGNORE INTO kinds ( name ) SELECT DISTINCT kind FROM nodes_v0;' )
+            self.cursor.execute(
+                'INSERT INTO nodes ( name, kind, key, link, parent, decl, comments ) ' +
+                    'SELECT nodes_v0.name, kinds.id, key, link, parent, decl, comments FROM nodes_v0 ' +
+                    'JOIN kinds ON kinds.name = nodes_v0.kind ORDER BY nodes_v0.rowid;' )
+            self.cursor.execute( 'DROP TABLE nodes_v0;' )
+        self.create_tables()
+        self.cursor.execute( f'PRAGMA user_version = {schema_version};' )
+
+    def has_table( self, name ):
+        return self.cursor.execute( "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", ( name, ) ).fetchone() != None
+
     def create_tables( self ):
+        # Keys are not unique, overloads and their parameters share them.
+        # Siblings are listed in id order.
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS kinds (
+                id INTEGER PRIMARY KEY,
+                name VARCHAR(64) UNIQUE
+            );''' )
         self.cursor.execute( '''CREATE TABLE IF NOT EXISTS nodes (
+                id INTEGER PRIMARY KEY,
+                name VARCHAR(64),
+                kind INTEGER REFERENCES kinds ( id ),
+                key VARCHAR(128),
+                link VARCHAR(128),
+                parent VARCHAR(128),
+                decl TEXT,
+                comments TEXT
+            );''' )
+        self.cursor.execute( 'CREATE INDEX IF NOT EXISTS nodes_key ON nodes ( key );' )
+        self.cursor.execute( 'CREATE INDEX IF NOT EXISTS nodes_parent ON nodes ( parent );' )
+
+        # Manifest used to only re-parse what changed since the previous run.
+        # files: every source/header seen, in the order they were first documented.
+        # units: the files each translation unit depends on.
+        # file_nodes: the records each documented file produced, nodes is built from them.
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                position INTEGER,
+                mtime REAL,
+                size INTEGER,
+                hash VARCHAR(40),
+                documented INTEGER DEFAULT 0
+            );''' )
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS units (
+                unit TEXT,
+                path TEXT
+            );''' )
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS file_nodes (
+                path TEXT,
+                seq INTEGER,
                 name VARCHAR(64),
                 kind VARCHAR(64),
                 key VARCHAR(128),
@@ -22,31 +164,144 @@ class CPPDatabase:
                 decl TEXT,
                 comments TEXT
             );''' )
+        # HTML of the comments keyed by comment_hash(), rendered by cppdoc --render-comments
+        # or kept between builds by gendoc --cache-comments.
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS comment_html (
+                hash VARCHAR(40) PRIMARY KEY,
+                html TEXT
+            );''' )
+        # Fingerprints of the pages gendoc wrote in each site directory.
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS pages (
+                site TEXT,
+                path TEXT,
+                fingerprint VARCHAR(40),
+                PRIMARY KEY ( site, path )
+            );''' )
+        # Content hashes of the files gendoc --compress compressed in each site directory.
+        self.cursor.execute( '''CREATE TABLE IF NOT EXISTS outputs (
+                site TEXT,
+                path TEXT,
+                hash VARCHAR(40),
+                PRIMARY KEY ( site, path )
+            );''' )
+        self.cursor.execute( 'CREATE INDEX IF NOT EXISTS units_unit ON units ( unit );' )
+        self.cursor.execute( 'CREATE INDEX IF NOT EXISTS file_nodes_path ON file_nodes ( path );' )
 
-    def insert_records( self, nodes ):
-        for node in nodes:
-            if node['name'] == '':
-                continue
-            link = node['link']
-            if '#' in link:
-                link = link.replace( '#', '.html#' )
-            elif '?' in link:
-                link = link.replace( '?', '.html?' )
-            else:
-                link = link + '.html'
-            if node.get( 'access', 'public' ) == 'private':
-                if len( node['comments'] ) == 0:
-                    continue
-            name = node['name']
-            parent = '/'.join( node['key'][:-1] )
-            key = '/'.join( node['key'] )
-            kind = node['kind']
-            decl = node['decl']
-            cmts = '\n'.join( node['comments'] )
+    def clear( self ):
+        for table in [ 'nodes', 'files', 'units', 'file_nodes' ]:
+            self.cursor.execute( f'DELETE FROM {table};' )
 
-            self.cursor.execute(
-                'INSERT OR FAIL INTO nodes ( name, kind, key, link, parent, decl, comments ) ' +
-                    'VALUES ( ?, ?, ?, ?, ?, ?, ? );',
-                    ( name, kind, key, link, parent, decl, cmts ) )
-        for node in nodes:
-            self.insert_records( node['children'] )
+    # Ids of the kinds, added to the kinds table when missing.
+    def kind_ids( self, kinds ):
+        self.cursor.executemany( 'INSERT OR IGNORE INTO kinds ( name ) VALUES ( ? );', [ ( kind, ) for kind in set( kinds ) ] )
+        return dict( [ ( name, id ) for ( id, name ) in self.cursor.execute( 'SELECT id, name FROM kinds;' ) ] )
+
+    def file_info( self, path ):
+        return self.cursor.execute(
+            'SELECT mtime, size, hash, documented FROM files WHERE path = ?;', ( path, ) ).fetchone()
+
+    def documented_files( self ):
+        return self.cursor.execute( 'SELECT path, hash FROM files WHERE documented = 1;' ).fetchall()
+
+    def unreferenced_files( self ):
+        rows = self.cursor.execute( 'SELECT path FROM files WHERE path NOT IN ( SELECT path FROM units );' ).fetchall()
+        return [ row[0] for row in rows ]
+
+    def unit_files( self, unit ):
+        rows = self.cursor.execute( 'SELECT path FROM units WHERE unit = ?;', ( unit, ) ).fetchall()
+        return [ row[0] for row in rows ]
+
+    # Units depending on a file, the main file of a translation unit being one of its dependencies.
+    def file_units( self, path ):
+        rows = self.cursor.execute( 'SELECT DISTINCT unit FROM units WHERE path = ?;', ( path, ) ).fetchall()
+        return [ row[0] for row in rows ]
+
+    def comment_html( self, key ):
+        row = self.cursor.execute( 'SELECT html FROM comment_html WHERE hash = ?;', ( key, ) ).fetchone()
+        return row[0] if row else None
+
+    def save_comment_html( self, rows ):
+        self.cursor.executemany( 'INSERT OR REPLACE INTO comment_html ( hash, html ) VALUES ( ?, ? );', rows )
+
+    # The comments of the nodes and of the records they are built from.
+    def comment_texts( self ):
+        rows = self.cursor.execute( 'SELECT comments FROM nodes UNION SELECT comments FROM file_nodes;' ).fetchall()
+        return [ row[0] for row in rows ]
+
+    # Remove the HTML of the comments whose hash is not in keys, returns the number of rows removed.
+    def prune_comment_html( self, keys ):
+        stale = [ row for row in self.cursor.execute( 'SELECT hash FROM comment_html;' ).fetchall() if row[0] not in keys ]
+        self.cursor.executemany( 'DELETE FROM comment_html WHERE hash = ?;', stale )
+        return len( stale )
+
+    def page_fingerprints( self, site ):
+        return dict( self.cursor.execute( 'SELECT path, fingerprint FROM pages WHERE site = ?;', ( site, ) ).fetchall() )
+
+    def save_page_fingerprints( self, site, fingerprints ):
+        self.cursor.execute( 'DELETE FROM pages WHERE site = ?;', ( site, ) )
+        self.cursor.executemany( 'INSERT INTO pages ( site, path, fingerprint ) VALUES ( ?, ?, ? );',
+            [ ( site, path, fingerprint ) for ( path, fingerprint ) in fingerprints.items() ] )
+
+    def output_hashes( self, site ):
+        return dict( self.cursor.execute( 'SELECT path, hash FROM outputs WHERE site = ?;', ( site, ) ).fetchall() )
+
+    def save_output_hashes( self, site, hashes ):
+        self.cursor.execute( 'DELETE FROM outputs WHERE site = ?;', ( site, ) )
+        self.cursor.executemany( 'INSERT INTO outputs ( site, path, hash ) VALUES ( ?, ?, ? );',
+            [ ( site, path, digest ) for ( path, digest ) in hashes.items() ] )
+
+    def update_file( self, path, mtime, size, digest ):
+        self.cursor.execute(
+            'INSERT INTO files ( path, position, mtime, size, hash ) ' +
+                'VALUES ( ?, ( SELECT IFNULL( MAX( position ), 0 ) + 1 FROM files ), ?, ?, ? ) ' +
+                'ON CONFLICT ( path ) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, hash = excluded.hash;',
+                ( path, mtime, size, digest ) )
+
+    def update_unit( self, unit, paths ):
+        self.cursor.execute( 'DELETE FROM units WHERE unit = ?;', ( unit, ) )
+        self.cursor.executemany( 'INSERT INTO units ( unit, path ) VALUES ( ?, ? );', [ ( unit, p ) for p in paths ] )
+
+    def forget_unit( self, unit ):
+        self.cursor.execute( 'DELETE FROM units WHERE unit = ?;', ( unit, ) )
+
+    def replace_file_records( self, path, nodes ):
+        self.cursor.execute( 'DELETE FROM file_nodes WHERE path = ?;', ( path, ) )
+        self.insert_rows(
+            'INSERT INTO file_nodes ( path, seq, name, kind, key, link, parent, decl, comments ) ' +
+                'VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? );',
+                ( ( path, seq ) + row for ( seq, row ) in enumerate( node_rows( nodes ) ) ) )
+        self.cursor.execute( 'UPDATE files SET documented = 1 WHERE path = ?;', ( path, ) )
+
+    def forget_file( self, path ):
+        self.cursor.execute( 'DELETE FROM file_nodes WHERE path = ?;', ( path, ) )
+        self.cursor.execute( 'DELETE FROM files WHERE path = ?;', ( path, ) )
+
+    # Rebuild the nodes table from the records of every documented file.
+    # Files are visited in the order they were first documented; a key already produced
+    # by an earlier file only adds its comments to it.
+    def update_nodes( self ):
+        rows = []
+        owner = {}
+        records = self.cursor.execute(
+            'SELECT file_nodes.path, name, kind, key, link, parent, decl, comments FROM file_nodes ' +
+                'JOIN files ON files.path = file_nodes.path ORDER BY files.position, file_nodes.seq;' ).fetchall()
+        for ( path, *row ) in records:
+            key = row[2]
+            first = owner.get( key, None )
+            if first == None:
+                owner[key] = ( path, len( rows ) )
+                rows.append( row )
+            elif first[0] == path:
+                rows.append( row )
+            elif row[6]:
+                merged = rows[first[1]]
+                merged[6] = merged[6] + '\n' + row[6] if merged[6] else row[6]
+        self.cursor.execute( 'DELETE FROM nodes;' )
+        self.insert_nodes( rows )
+
+    def insert_nodes( self, rows ):
+        kinds = self.kind_ids( [ row[1] for row in rows ] )
+        self.insert_rows(
+            'INSERT INTO nodes ( name, kind, key, link, parent, decl, comments ) ' +
+                'VALUES ( ?, ?, ?, ?, ?, ?, ? );',
+                ( ( row[0], kinds[row[1]] ) + tuple( row[2:] ) for row in rows ) )
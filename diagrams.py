@@ -0,0 +1,72 @@
+import os
+import json
+import base64
+import hashlib
+import tempfile
+from urllib.parse import quote as url_quote
+from markdown.util import etree
+from markdown_blockdiag.extension import BlockdiagExtension
+from markdown_blockdiag.parser import BlockdiagProcessor
+from markdown_blockdiag import utils
+
+# Replacement of the markdown_blockdiag extension keeping the rendered diagrams in a directory.
+# Files are named after the hash of the diagram source and the drawing options, so an
+# unchanged diagram is read back instead of being laid out and drawn again.
+
+def diagram_key( source, output_fmt, font_path, font_antialias ):
+    import blockdiag
+    text = json.dumps( [ blockdiag.__version__, source, output_fmt, font_path, font_antialias ] )
+    return hashlib.sha1( text.encode() ).hexdigest()
+
+def draw_cached( cache, source, output_fmt, font_path, font_antialias ):
+    filename = os.path.join( cache, diagram_key( source, output_fmt, font_path, font_antialias ) + '.' + output_fmt )
+    mode = 'b' if output_fmt == 'png' else ''
+    try:
+        with open( filename, 'r' + mode ) as f:
+            return f.read()
+    except OSError:
+        pass
+
+    diagram = utils.draw_blockdiag( source, output_fmt = output_fmt, font_path = font_path, font_antialias = font_antialias )
+    # Written to a temporary file first, several processes can render the same diagram.
+    os.makedirs( cache, exist_ok = True )
+    ( fd, tmp ) = tempfile.mkstemp( dir = cache )
+    with os.fdopen( fd, 'w' + mode ) as f:
+        f.write( diagram )
+    os.replace( tmp, filename )
+    return diagram
+
+class CachedBlockdiagProcessor( BlockdiagProcessor ):
+    def run( self, parent, blocks ):
+        diag_blocks = []
+        for block in blocks:
+            block = block.strip()
+            diag_blocks.append( block )
+            if block.endswith( "}" ):
+                break
+
+        raw_block = "\n".join( diag_blocks )
+        del blocks[:len( diag_blocks )]
+
+        output_fmt = self.extension.getConfig( 'format' )
+        diagram = draw_cached( self.extension.cache, raw_block, output_fmt,
+            self.extension.getConfig( 'fontpath' ), self.extension.getConfig( 'fontantialias' ) )
+        if output_fmt == 'png':
+            src_data = 'data:image/png;base64,{0}'.format( base64.b64encode( diagram ).decode( 'ascii' ) )
+        else:
+            src_data = 'data:image/svg+xml;charset=utf-8,{0}'.format( url_quote( diagram ) )
+
+        p = etree.SubElement( parent, 'p' )
+        img = etree.SubElement( p, 'img' )
+        img.attrib['src'] = src_data
+
+class CachedBlockdiagExtension( BlockdiagExtension ):
+    def __init__( self, cache, **kwargs ):
+        self.cache = cache
+        super().__init__( **kwargs )
+
+    def extendMarkdown( self, md, md_globals ):
+        md.parser.blockprocessors.add(
+            'blockdiag', CachedBlockdiagProcessor( md.parser, self ), '>indent'
+        )
+        md.registerExtension( self )
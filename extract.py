@@ -0,0 +1,324 @@
+
+import os
+import json
+import hashlib
+import pathlib
+from multiprocessing import Pool, Manager
+from clang.cindex import Index, TranslationUnit, CompilationDatabase, TranslationUnitLoadError, TranslationUnitSaveError
+from comments import gather_files
+from cleanup import Cleanup, comment_hash, comment_hashes
+
+global topdir, claims, ast_cache, parse_options, cleaner
+topdir = None
+claims = {}
+ast_cache = None
+parse_options = 0
+cleaner = None
+
+# Fast extraction: function bodies are never needed to document declarations.
+fast_options = TranslationUnit.PARSE_SKIP_FUNCTION_BODIES | TranslationUnit.PARSE_INCOMPLETE
+
+def init_worker( directory, registry, cache = None, options = 0, render = False ):
+    global topdir, claims, ast_cache, parse_options, cleaner
+    topdir = directory
+    claims = registry
+    ast_cache = cache
+    parse_options = options
+    cleaner = Cleanup() if render else None
+
+def file_digest( path ):
+    with open( path, 'rb' ) as f:
+        return hashlib.sha1( f.read() ).hexdigest()
+
+# A file is documented by the first translation unit that claims it.
+# The registry is keyed by the resolved path and content of the file, so every
+# other translation unit including the same header can skip it.
+def claim_file( path, owner ):
+    key = ( str( path ), file_digest( path ) )
+    return claims.setdefault( key, owner ) == owner
+
+def read_list_file( listfile ):
+    # One source file per line, blank lines and # comments are ignored.
+    result = []
+    with open( listfile ) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith( '#' ):
+                result.append( line )
+    return result
+
+# Compiler flags that only make sense when actually compiling ( flag, takes an argument ).
+compile_only_flags = {
+    '-c': False,
+    '-o': True,
+    '-MD': False,
+    '-MMD': False,
+    '-MP': False,
+    '-MF': True,
+    '-MT': True,
+    '-MQ': True,
+}
+
+def compdb_arguments( cmd, filename ):
+    args = []
+    arguments = list( cmd.arguments )[1:] # Drop the compiler itself
+    skip = False
+    for arg in arguments:
+        if skip:
+            skip = False
+            continue
+        if arg in compile_only_flags:
+            skip = compile_only_flags[arg]
+            continue
+        if arg.startswith( '-o' ) and len( arg ) > 2:
+            continue
+        if not arg.startswith( '-' ) and pathlib.Path( cmd.directory, arg ).resolve() == filename:
+            continue
+        args.append( arg )
+    return [ '-working-directory', cmd.directory ] + args
+
+# Load every translation unit of the compile_commands.json found in directory.
+# Returns ( filename, clang_args ) jobs, with the file resolved to an absolute path.
+def load_compdb( directory ):
+    db = CompilationDatabase.fromDirectory( directory )
+    jobs = []
+    for cmd in db.getAllCompileCommands():
+        filename = pathlib.Path( cmd.directory, cmd.filename ).resolve()
+        jobs.append( ( str( filename ), compdb_arguments( cmd, filename ) ) )
+    return jobs
+
+# Remove the jobs parsing the same main file with the same flags.
+def unique_jobs( jobs ):
+    result = []
+    seen = set()
+    for ( filename, clang_args ) in jobs:
+        key = ( str( pathlib.Path( filename ).resolve() ), tuple( clang_args ) )
+        if key not in seen:
+            seen.add( key )
+            result.append( ( filename, clang_args ) )
+    return result
+
+# Files included by the translation unit, in the order the preprocessor reached them.
+# Rebuilt from the include locations since a translation unit read back from
+# an AST file does not report its includes in that order.
+def included_files( tu ):
+    children = {}
+    for inc in tu.get_includes():
+        children.setdefault( str( inc.source.name ), [] ).append( ( inc.location.offset, str( inc.include.name ) ) )
+    result = []
+    seen = set()
+    def visit( name ):
+        for ( offset, child ) in sorted( children.get( name, [] ) ):
+            if child not in seen:
+                seen.add( child )
+                result.append( child )
+                visit( child )
+    visit( tu.spelling )
+    return result
+
+# Parse a translation unit, or read it back from the AST cache when none of its files
+# were modified since it was saved there.
+def load_tu( index, filename, clang_args, options = 0 ):
+    cache = None
+    if ast_cache:
+        name = json.dumps( [ str( pathlib.Path( filename ).resolve() ), clang_args, options ] )
+        cache = pathlib.Path( ast_cache ) / ( hashlib.sha1( name.encode() ).hexdigest() + '.ast' )
+        if cache.exists():
+            try:
+                tu = index.read( str( cache ) )
+                saved = cache.stat().st_mtime
+                if all( [ os.stat( f ).st_mtime <= saved for f in [ tu.spelling ] + included_files( tu ) ] ):
+                    return tu
+            except ( TranslationUnitLoadError, OSError ):
+                pass
+
+    tu = index.parse( filename, clang_args, options = options )
+    if tu and cache:
+        try:
+            cache.parent.mkdir( parents = True, exist_ok = True )
+            tu.save( str( cache ) )
+        except TranslationUnitSaveError:
+            pass
+    return tu
+
+def parse_tu( job ):
+    ( owner, ( filename, clang_args ) ) = job
+    index = Index.create()
+    tu = load_tu( index, filename, clang_args, parse_options )
+    if not tu:
+        raise Exception( "unable to load input " + filename )
+
+    for diag in tu.diagnostics:
+        print( diag )
+    print( '~~~~~~~~~~' )
+
+    # Relative include names are relative to the directory clang was run from.
+    workdir = None
+    if '-working-directory' in clang_args:
+        workdir = clang_args[clang_args.index( '-working-directory' ) + 1]
+    def resolve( name ):
+        return pathlib.Path( workdir or '.', name ).resolve()
+
+    includes = included_files( tu )
+    files = [ tu.spelling ] + [ name for name in includes if topdir in resolve( name ).parents ]
+
+    # Every file the translation unit depends on, to know when it needs to be parsed again.
+    deps = []
+    for name in [ tu.spelling ] + includes:
+        path = str( resolve( name ) )
+        if path not in deps:
+            deps.append( path )
+
+    # Only document the files no other translation unit has claimed yet.
+    files = [ name for name in files if claim_file( resolve( name ), owner ) ]
+
+    skip_bodies = ( parse_options & TranslationUnit.PARSE_SKIP_FUNCTION_BODIES ) != 0
+    trees = [ ( str( resolve( name ) ), tree ) for ( name, tree ) in gather_files( tu, files, skip_bodies ) ]
+    return ( owner, deps, trees, render_comments( trees ) )
+
+# HTML of the comments of the trees as ( comment hash, html ) rows, when rendering while extracting.
+def render_comments( trees ):
+    result = {}
+    def visit( nodes ):
+        for node in nodes:
+            if node['comments']:
+                cmts = '\n'.join( node['comments'] )
+                key = comment_hash( cmts )
+                if key not in result:
+                    result[key] = cleaner( cmts )
+            visit( node['children'] )
+    if cleaner:
+        for ( path, nodes ) in trees:
+            visit( nodes )
+    return list( result.items() )
+
+def default_jobs():
+    return len( os.sched_getaffinity( 0 ) ) if hasattr( os, 'sched_getaffinity' ) else os.cpu_count()
+
+# Parse every ( filename, clang_args ) job, yielding ( job index, dependencies, file trees, comments html ).
+# claimed holds the files that are already documented and do not need to be extracted again.
+# With render, the comments are converted to HTML by the workers.
+# Results are yielded in job order so the output does not depend on which worker finished first.
+def extract( jobs, directory, processes = 1, claimed = {}, cache = None, options = 0, render = False ):
+    jobs = list( enumerate( jobs ) )
+    processes = max( 1, min( processes, len( jobs ) ) )
+    if processes == 1:
+        init_worker( directory, dict( claimed ), cache, options, render )
+        for job in jobs:
+            yield parse_tu( job )
+    else:
+        with Manager() as manager:
+            registry = manager.dict( claimed )
+            with Pool( processes, initializer = init_worker, initargs = ( directory, registry, cache, options, render ) ) as pool:
+                yield from pool.imap( parse_tu, jobs )
+
+# Translation units are recorded with everything changing what gets extracted from them:
+# their flags, the documented directory and the parse options.
+def unit_name( job, directory, options ):
+    ( filename, clang_args ) = job
+    return json.dumps( [ str( pathlib.Path( filename ).resolve() ), clang_args, str( directory ), options ] )
+
+# Units recorded for the main file of a job with other settings.
+def stale_units( db, job, unit ):
+    path = str( pathlib.Path( job[0] ).resolve() )
+    return [ name for name in db.file_units( path ) if name != unit and json.loads( name )[0] == path ]
+
+# Current ( mtime, size, hash ) of the files, compared to what the database recorded.
+# Files are only hashed again when their modification time or size changed.
+class FileStates:
+    def __init__( self, db ):
+        self.db = db
+        self.states = {}
+
+    def state( self, path ):
+        if path not in self.states:
+            result = None
+            try:
+                st = os.stat( path )
+                info = self.db.file_info( path )
+                if info and info[0] == st.st_mtime and info[1] == st.st_size:
+                    digest = info[2]
+                else:
+                    digest = file_digest( path )
+                result = ( st.st_mtime, st.st_size, digest )
+            except OSError:
+                pass
+            self.states[path] = result
+        return self.states[path]
+
+    def changed( self, path ):
+        info = self.db.file_info( path )
+        state = self.state( path )
+        return info == None or state == None or info[2] != state[2]
+
+# Parse the translation units that changed since the last run and update the database.
+# A unit is parsed again when its main file or any of its includes changed; only
+# the records of the files it documents are replaced.
+def update( db, jobs, directory, processes = 1, cache = None, options = 0, render = False ):
+    states = FileStates( db )
+    todo = []
+    stale = []
+    outdated = set()
+    for job in jobs:
+        unit = unit_name( job, directory, options )
+        deps = db.unit_files( unit )
+        if not deps or any( [ states.changed( path ) for path in deps ] ):
+            todo.append( job )
+        # The files extracted with other settings are extracted again.
+        for name in stale_units( db, job, unit ):
+            stale.append( name )
+            outdated.update( db.unit_files( name ) )
+    print( f'parsing {len( todo )} of {len( jobs )} translation units' )
+    if not todo:
+        return
+
+    # Unchanged files stay documented by whoever documented them before.
+    claimed = {}
+    changed = []
+    for ( path, digest ) in db.documented_files():
+        if path in outdated or states.changed( path ):
+            changed.append( path )
+        else:
+            claimed[( path, digest )] = -1
+
+    # Every translation unit is written in its own transaction.
+    documented = set()
+    parsed = set()
+    for ( index, deps, trees, comments ) in extract( todo, directory, processes, claimed, cache, options, render ):
+        with db.transaction():
+            for path in deps:
+                state = states.state( path )
+                if state:
+                    db.update_file( path, *state )
+            unit = unit_name( todo[index], directory, options )
+            db.update_unit( unit, deps )
+            parsed.add( unit )
+            for ( path, nodes ) in trees:
+                db.replace_file_records( path, nodes )
+                documented.add( path )
+            db.save_comment_html( comments )
+
+    with db.transaction():
+        for unit in stale:
+            db.forget_unit( unit )
+
+        # Changed files nobody documents anymore (removed, or not included anymore).
+        # Checked again since another process sharing the database may have documented them meanwhile.
+        # A file still included by a unit that was not parsed in this run keeps its records until it is.
+        for path in changed:
+            if path not in documented and ( path in outdated or states.changed( path ) ):
+                if all( [ unit in parsed for unit in db.file_units( path ) ] ):
+                    db.forget_file( path )
+
+        # Files no translation unit includes anymore.
+        for path in db.unreferenced_files():
+            db.forget_file( path )
+
+        # A file documented by several processes keeps the records of the last one, and keys
+        # found in several files are merged in the order the files were first recorded.
+        db.update_nodes()
+
+        # HTML of comments that changed or are gone.
+        if render:
+            db.prune_comment_html( comment_hashes( db.comment_texts() ) )
+    db.report()
@@ -1,12 +1,18 @@
 
-import sqlite3
 import yaml
 import os
+import json
+import hashlib
 from pprint import pprint
 from pathlib import Path
-from cleanup import Cleanup
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from multiprocessing import Pool
+from cleanup import Cleanup, comment_hashes
+from cppdb import CPPDatabase
+from search import write_search_index, write_if_changed
+from compress import minify_html, compress_site, remove_siblings, compressors
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 from html import escape
+from functools import lru_cache
 
 order = [ "Template Parameters", "Namespaces", "Types", "Parameters", "Constructors", "Destructor", "Fields", "Public", "Methods", "Friends", "Protected" ]
 
@@ -30,49 +36,260 @@ def filter_kind( nodes, kind ):
     else:
         return filter( lambda n: n['kind'] in kind, nodes )
 
+page_kinds = [ 'class', 'struct', 'namespace', 'global' ]
+
+# Declaration highlighted at build time, see HTMLGenerator( highlight = True ).
+# Many declarations are identical ( parameters, overloads ), they are only highlighted once.
+@lru_cache( maxsize = 16384 )
+def highlight_decl( decl ):
+    from pygments import highlight
+    from pygments.lexers import CppLexer
+    from pygments.formatters import HtmlFormatter
+    return highlight( decl, CppLexer(), HtmlFormatter( nowrap = True ) ).rstrip( '\n' )
+
+# Navigation data of a page, written next to the site when the table of content is loaded lazily.
+def nav_file( node ):
+    return Path( 'nav' ) / html_file( node ).with_suffix( '.json' )
+
+def nav_link( node ):
+    return '/' + nav_file( node ).as_posix()
+
 def anchor( node ):
     result = None
     if '#' in node['link']:
         result = node['link'].split( '#' )[-1]
     return result
 
+# Part of the page fingerprints, change it when the way pages are rendered changes
+# so every page is written again.
+page_version = 1
+
+# Hash of everything a page is rendered from: the node, the two levels below it the
+# templates show, the breadcrumb of its parents, and the templates and options they are rendered with.
+def page_fingerprint( node, parents, templates ):
+    def content( n, depth ):
+        children = [ content( c, depth - 1 ) for c in n['children'] ] if depth > 0 else []
+        return [ n['name'], n['key'], n['link'], n['kind'], n['decl'], n['comments'], children ]
+    text = json.dumps( [ page_version, templates, [ [ p['name'], p['link'] ] for p in parents ], content( node, 2 ) ] )
+    return hashlib.sha1( text.encode() ).hexdigest()
+
+def templates_hash( directory ):
+    h = hashlib.sha1()
+    for path in sorted( Path( directory ).rglob( '*' ) ):
+        if path.is_file():
+            h.update( str( path.relative_to( directory ) ).encode() + b'\0' + path.read_bytes() + b'\0' )
+    return h.hexdigest()
+
+# Generator of the pool workers, see HTMLGenerator.generate_pages().
+global generator
+generator = None
+
+def init_worker( dbfile, topdir, cache_comments, diagram_cache, template_cache, lazy_toc, highlight, minify ):
+    global generator
+    generator = HTMLGenerator( dbfile, topdir, cache_comments, diagram_cache, template_cache, lazy_toc, highlight, minify )
+
+def render_page( page ):
+    return generator.render_page( page )
+
 class HTMLGenerator:
-    def __init__( self, dbfile, topdir ):
+    # Comments already converted by cppdoc --render-comments or a previous build are read from the
+    # database. With cache_comments, the new conversions are saved there for the next builds, and
+    # the ones no comment of the database needs anymore are removed.
+    # With diagram_cache, the diagrams are kept in that directory.
+    # Compiled templates are kept in template_cache, or in a directory of the system temporary folder.
+    # With lazy_toc, the table of content of each page is written in a JSON file the page loads.
+    # With highlight, declarations and code blocks are highlighted with Pygments instead of in the browser.
+    # With minify, the blanks and comments of the pages are removed.
+    def __init__( self, dbfile, topdir, cache_comments = False, diagram_cache = None, template_cache = None, lazy_toc = False, highlight = False, minify = False ):
+        self.dbfile = dbfile
         self.topdir = topdir
-        self.connection = sqlite3.connect( dbfile )
-        self.cursor = self.connection.cursor()
+        self.cache_comments = cache_comments
+        self.diagram_cache = diagram_cache
+        self.template_cache = template_cache
+        self.lazy_toc = lazy_toc
+        self.highlight = highlight
+        self.minify = minify
+        # Opened through CPPDatabase so databases of an older schema are migrated first.
+        self.db = CPPDatabase( dbfile )
+        self.cursor = self.db.cursor
         loc = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), "templates" )
+        # Templates do not change during a build, no need to check them for every page.
+        if template_cache:
+            os.makedirs( template_cache, exist_ok = True )
         self.env = Environment(
-            loader = FileSystemLoader( loc )
+            loader = FileSystemLoader( loc ),
+            bytecode_cache = FileSystemBytecodeCache( template_cache ),
+            auto_reload = False
         )
         self.env.filters['filter_kind'] = filter_kind
         self.env.globals['list'] = list
         self.env.globals['anchor'] = anchor
-        self.cleaner = Cleanup()
+        self.env.globals['nav_link'] = nav_link
+        self.env.globals['lazy_toc'] = lazy_toc
+        self.env.globals['highlight'] = highlight
+        self.templates = json.dumps( [ templates_hash( loc ), lazy_toc, highlight, minify ] )
+        self.cleaner = Cleanup( store = self.db, diagram_cache = diagram_cache, save = cache_comments, pygments = highlight )
+
+    def save_comments( self ):
+        if self.cleaner.pending:
+            with self.db.transaction():
+                self.cleaner.flush()
 
-    def generate( self ):
-        top = {
+    def top_node( self, children ):
+        return {
             'name': '',
+            'key': '',
             'link': '/index.html',
             'kind': 'global',
             'decl': '',
             'comments': '',
-            'children': self.load_nodes(),
+            'children': children,
         }
-        #pprint( top, sort_dicts=False )
-        self.generate_node( top, [] )
 
-    def load_nodes( self, parent = '' ):
-        rows = self.cursor.execute( f'SELECT name, key, link, kind, decl, comments FROM nodes WHERE parent="{parent}";' ).fetchall();
-        nodes = []
+    # Pages are only written when their fingerprint changed since the previous build in the same
+    # directory, or with rebuild. Pages of the previous build that are not generated anymore are removed,
+    # with rebuild as well.
+    # With stream or several jobs, the pages are loaded and rendered one at a time instead of
+    # loading the whole tree first, so memory is bounded by the largest page.
+    # Every text file of the site then gets compressed siblings in the compress formats ( 'gz', 'br' ).
+    # Without compress, the siblings written by a previous build are removed, they would be stale.
+    def generate( self, jobs = 1, rebuild = False, stream = False, compress = [] ):
+        site = str( self.topdir.resolve() )
+        self.previous = self.db.page_fingerprints( site )
+        self.rebuild = rebuild
+        self.fingerprints = {}
+        self.written = 0
+        if jobs > 1 or stream:
+            self.generate_pages( jobs )
+        else:
+            top = self.top_node( self.load_nodes() )
+            self.save_comments()
+            #pprint( top, sort_dicts=False )
+            self.generate_node( top, [] )
+
+        removed = [ path for path in self.previous if path not in self.fingerprints ]
+        for path in removed:
+            navfile = Path( 'nav' ) / Path( path ).with_suffix( '.json' )
+            ( self.topdir / path ).unlink( missing_ok = True )
+            ( self.topdir / navfile ).unlink( missing_ok = True )
+            remove_siblings( self.topdir, [ path, navfile.as_posix() ], compressors )
+        with self.db.transaction():
+            self.db.save_page_fingerprints( site, self.fingerprints )
+            if self.cache_comments:
+                # HTML of comments that changed or are gone.
+                self.db.prune_comment_html( comment_hashes( self.db.comment_texts() ) )
+        print( f'wrote {self.written} of {len( self.fingerprints )} pages, removed {len( removed )}' )
+
+        ( written, shards ) = write_search_index( self.cursor, self.topdir )
+        print( f'wrote {written} of {shards} search index files' )
+
+        previous = self.db.output_hashes( site )
+        if compress:
+            ( hashes, written ) = compress_site( self.topdir, compress, previous, jobs, rebuild )
+            with self.db.transaction():
+                self.db.save_output_hashes( site, hashes )
+            print( f'compressed {written} of {len( hashes )} files' )
+        elif previous:
+            remove_siblings( self.topdir, previous, compressors )
+            with self.db.transaction():
+                self.db.save_output_hashes( site, {} )
+            print( f'removed the compressed copies of {len( previous )} files' )
+
+    # Load the nodes below parent in one pass over the table, then build the tree from a
+    # parent -> rows map. Only the subtree of parent is read unless it is the global scope,
+    # and only depth levels of it when given.
+    def load_nodes( self, parent = '', depth = None ):
+        columns = 'nodes.name, key, link, kinds.name, decl, comments, parent FROM nodes JOIN kinds ON kinds.id = nodes.kind'
+        if parent == '' and depth == None:
+            rows = self.cursor.execute( f'SELECT {columns} ORDER BY nodes.id;' )
+        else:
+            rows = self.cursor.execute(
+                'WITH RECURSIVE subtree ( key, depth ) AS ( VALUES ( ?, 1 ) ' +
+                    'UNION SELECT nodes.key, subtree.depth + 1 FROM nodes JOIN subtree ON nodes.parent = subtree.key ' +
+                    'WHERE ? IS NULL OR subtree.depth < ? ) ' +
+                    f'SELECT {columns} WHERE parent IN ( SELECT key FROM subtree ) ORDER BY nodes.id;', ( parent, depth, depth ) )
+        children = {}
         for row in rows:
-            child = { 'name': row[0], 'key': row[1], 'link': row[2], 'kind': row[3], 'decl': escape( row[4] ), 'comments': row[5] }
+            children.setdefault( row[6], [] ).append( row )
+        return self.build_nodes( children, parent )
+
+    def decl_html( self, decl ):
+        return highlight_decl( decl ) if self.highlight and decl else escape( decl )
+
+    def build_nodes( self, children, parent ):
+        nodes = []
+        for row in children.get( parent, [] ):
+            child = { 'name': row[0], 'key': row[1], 'link': row[2], 'kind': row[3], 'decl': self.decl_html( row[4] ), 'comments': row[5] }
             child['comments'] = self.cleaner( child['comments'] )
-            child['children'] = self.load_nodes( child['key'] )
+            child['children'] = self.build_nodes( children, child['key'] )
             nodes.append( child )
         #nodes.sort( key=lambda n: group_order( n['name'] ) )
         return nodes
 
+    # The node of a page with the two levels below it the templates show (groups and their members).
+    def load_page( self, id ):
+        if id == None:
+            return self.top_node( self.load_nodes( '', 2 ) )
+        row = self.cursor.execute(
+            'SELECT nodes.name, key, link, kinds.name, decl, comments FROM nodes ' +
+                'JOIN kinds ON kinds.id = nodes.kind WHERE nodes.id = ?;', ( id, ) ).fetchone()
+        node = { 'name': row[0], 'key': row[1], 'link': row[2], 'kind': row[3], 'decl': self.decl_html( row[4] ), 'comments': self.cleaner( row[5] ) }
+        node['children'] = self.load_nodes( node['key'], 2 )
+        return node
+
+    # Every page to write as ( path, node id, parents, previous fingerprint ), where the parents only hold the names and
+    # links the templates need. Found the same way generate_node walks the tree; when several
+    # nodes write the same file the last one wins, like it does there.
+    # Only the page nodes and their ancestors are read, not the members.
+    def list_pages( self ):
+        kinds = ', '.join( [ f"'{kind}'" for kind in page_kinds ] )
+        children = {}
+        rows = self.cursor.execute(
+            'WITH RECURSIVE page_nodes ( id, name, key, link, kind, parent ) AS ( ' +
+                'SELECT nodes.id, nodes.name, key, link, kinds.name, parent FROM nodes JOIN kinds ON kinds.id = nodes.kind ' +
+                f'WHERE kinds.name IN ( {kinds} ) ), ' +
+            'ancestors ( key ) AS ( SELECT parent FROM page_nodes ' +
+                'UNION SELECT nodes.parent FROM nodes JOIN ancestors ON nodes.key = ancestors.key ) ' +
+            'SELECT * FROM page_nodes UNION ' +
+            'SELECT nodes.id, nodes.name, key, link, kinds.name, parent FROM nodes JOIN kinds ON kinds.id = nodes.kind ' +
+                'WHERE key IN ( SELECT key FROM ancestors ) ORDER BY 1;' )
+        for row in rows:
+            children.setdefault( row[5], [] ).append( { 'id': row[0], 'name': row[1], 'key': row[2], 'link': row[3], 'kind': row[4] } )
+
+        pages = {}
+        def visit( node, parents ):
+            for n in children.get( node['key'], [] ):
+                if node['kind'] == 'group':
+                    visit( n, parents )
+                else:
+                    visit( n, parents + [ { 'name': node['name'], 'link': node['link'] } ] )
+            if node['kind'] in page_kinds:
+                path = str( html_file( node ) )
+                pages.pop( path, None )
+                pages[path] = ( path, node['id'], parents, self.previous_fingerprint( path ) )
+        visit( { 'id': None, 'name': '', 'key': '', 'link': '/index.html', 'kind': 'global' }, [] )
+        return list( pages.values() )
+
+    # Render the pages one at a time, or in a pool of processes with several jobs.
+    # Only the nodes of the page being rendered are loaded.
+    def generate_pages( self, jobs ):
+        pages = self.list_pages()
+        if jobs > 1:
+            chunksize = max( 1, min( 64, len( pages ) // ( jobs * 4 ) ) )
+            with Pool( jobs, initializer = init_worker, initargs = ( self.dbfile, self.topdir, self.cache_comments, self.diagram_cache, self.template_cache, self.lazy_toc, self.highlight, self.minify ) ) as pool:
+                results = list( pool.imap_unordered( render_page, pages, chunksize ) )
+        else:
+            results = map( self.render_page, pages )
+        for ( path, fingerprint, written ) in results:
+            self.fingerprints[path] = fingerprint
+            self.written += written
+
+    def render_page( self, page ):
+        ( path, id, parents, previous ) = page
+        result = self.write_page( self.load_page( id ), parents, previous )
+        self.save_comments()
+        return ( path, ) + result
+
     def generate_node( self, node, parents ):
         for n in node['children']:
             if node['kind'] == 'group':
@@ -80,12 +297,39 @@ class HTMLGenerator:
             else:
                 self.generate_node( n, parents + [ node ] )
 
-        if node['kind'] in [ 'class', 'struct', 'namespace', 'global' ]:
-            filename = self.topdir / html_file( node )
-            assert '#' not in str( filename ), 'expected class/struct/namespace/global without fragment'
-            filename.parent.mkdir( parents = True, exist_ok = True )
-            template = self.env.get_template( node['kind'] + ".html" )
-            htmlData = template.render( node=node, parents=parents );
-            with filename.open( 'w' ) as f:
-                f.write( htmlData )
+        if node['kind'] in page_kinds:
+            path = str( html_file( node ) )
+            previous = self.fingerprints.get( path, self.previous_fingerprint( path ) )
+            ( self.fingerprints[path], written ) = self.write_page( node, parents, previous )
+            self.written += written
+
+    # Fingerprint of a page in the previous build, None when every page is written again.
+    def previous_fingerprint( self, path ):
+        return None if self.rebuild else self.previous.get( path, None )
+
+    # Returns ( fingerprint, whether the page was written ).
+    def write_page( self, node, parents, previous = None ):
+        filename = self.topdir / html_file( node )
+        assert '#' not in str( filename ), 'expected class/struct/namespace/global without fragment'
+        navfile = self.topdir / nav_file( node )
+        fingerprint = page_fingerprint( node, parents, self.templates )
+        if fingerprint == previous and filename.exists() and ( navfile.exists() or not self.lazy_toc ):
+            return ( fingerprint, False )
+        filename.parent.mkdir( parents = True, exist_ok = True )
+        template = self.env.get_template( node['kind'] + ".html" )
+        htmlData = template.render( node=node, parents=parents );
+        if self.minify:
+            htmlData = minify_html( htmlData )
+        with filename.open( 'w' ) as f:
+            f.write( htmlData )
+        if self.lazy_toc:
+            self.write_nav( node, navfile )
+        else:
+            navfile.unlink( missing_ok = True )
+        return ( fingerprint, True )
 
+    # The groups of the page and their members, as the table of content shows them.
+    def write_nav( self, node, navfile ):
+        nav = [ [ group['name'], [ [ n['name'], n['link'] ] for n in group['children'] ] ] for group in node['children'] ]
+        navfile.parent.mkdir( parents = True, exist_ok = True )
+        write_if_changed( navfile, json.dumps( nav, separators = ( ',', ':' ) ) )
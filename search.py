@@ -0,0 +1,89 @@
+import json
+from pathlib import Path
+
+# Client side search index, read by site/js/search.js.
+# search/index.json lists the kinds and the shards; each shard search/shards/<prefix>.json holds the
+# symbols whose lowercase name starts with that prefix as [ qualified name, kind, link, brief ].
+# Shards holding more than shard_size symbols are split on a longer prefix, so the browser
+# only downloads the few small shards matching what is typed.
+
+shard_size = 2000
+max_prefix = 32
+
+# Kinds not worth searching for.
+skipped_kinds = [ 'group', 'param', 'tparam' ]
+
+def name_prefix( name, length ):
+    result = ''
+    for c in name.lower()[:length]:
+        result += c if c.isascii() and c.isalnum() else '_'
+    return result
+
+def brief( comments ):
+    for line in comments.splitlines():
+        line = line.strip()
+        if line.startswith( '@brief' ):
+            line = line[len( '@brief' ):].strip()
+        if line:
+            return line if len( line ) <= 100 else line[:99] + '…'
+    return ''
+
+# Symbols as ( name, qualified name, kind, link, brief ), qualified names skipping the groups.
+def search_symbols( cursor ):
+    scopes = {}
+    rows = cursor.execute(
+        'SELECT nodes.name, kinds.name, key, link, parent, comments FROM nodes ' +
+            'JOIN kinds ON kinds.id = nodes.kind ORDER BY nodes.id;' )
+    for ( name, kind, key, link, parent, comments ) in rows:
+        scope = scopes.get( parent, '' )
+        if kind == 'group':
+            scopes[key] = scope
+            continue
+        qualified = scope + '::' + name if scope else name
+        scopes.setdefault( key, qualified )
+        if kind not in skipped_kinds:
+            yield ( name, qualified, kind, link, brief( comments ) )
+
+# Split the symbols on longer prefixes until every shard is small enough.
+# Symbols whose name is shorter than the prefix stay in the shard of the shorter prefix.
+def split_shards( symbols, length, shards, prefix = '' ):
+    groups = {}
+    for symbol in symbols:
+        groups.setdefault( name_prefix( symbol[0], length ), [] ).append( symbol )
+    for ( key, group ) in groups.items():
+        if len( group ) > shard_size and length < max_prefix and key != prefix:
+            split_shards( group, length + 1, shards, key )
+        else:
+            shards.setdefault( key, [] ).extend( group )
+
+def write_if_changed( filename, text ):
+    try:
+        if filename.read_text() == text:
+            return False
+    except OSError:
+        pass
+    filename.write_text( text )
+    return True
+
+# Write the search index in topdir/search, returns ( shards written, shards ).
+def write_search_index( cursor, topdir ):
+    directory = Path( topdir ) / 'search'
+    ( directory / 'shards' ).mkdir( parents = True, exist_ok = True )
+    symbols = list( search_symbols( cursor ) )
+    kinds = sorted( set( [ symbol[2] for symbol in symbols ] ) )
+    shards = {}
+    split_shards( symbols, 1, shards )
+
+    written = 0
+    for ( prefix, group ) in shards.items():
+        group.sort( key = lambda s: ( s[0].lower(), s[1] ) )
+        entries = [ [ qualified, kinds.index( kind ), link, text ] for ( name, qualified, kind, link, text ) in group ]
+        written += write_if_changed( directory / 'shards' / ( prefix + '.json' ), json.dumps( entries, separators = ( ',', ':' ) ) )
+    index = { 'kinds': kinds, 'shards': sorted( shards.keys() ) }
+    written += write_if_changed( directory / 'index.json', json.dumps( index, separators = ( ',', ':' ) ) )
+
+    # Shards of a previous build that are not needed anymore.
+    for path in ( directory / 'shards' ).glob( '*.json' ):
+        if path.stem not in shards:
+            path.unlink()
+    return ( written, len( shards ) + 1 )
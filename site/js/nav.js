@@ -0,0 +1,25 @@
+// Fills the tables of content written by gendoc --lazy-toc from their JSON file,
+// [ [ group name, [ [ member name, link ], ... ] ], ... ], with the markup of toc.j2.
+document.addEventListener( 'DOMContentLoaded', function() {
+  document.querySelectorAll( '.lazy-toc' ).forEach( function( toc ) {
+    fetch( toc.dataset.nav ).then( function( r ) { return r.json(); } ).then( function( groups ) {
+      groups.forEach( function( group ) {
+        var badge = document.createElement( 'div' );
+        badge.className = 'badge rounded-pill bg-dark text-white';
+        badge.textContent = group[0];
+        toc.appendChild( badge );
+        var ul = document.createElement( 'ul' );
+        group[1].forEach( function( member ) {
+          var a = document.createElement( 'a' );
+          a.className = 'btn-link text-black my-1';
+          a.href = member[1];
+          a.textContent = member[0];
+          var li = document.createElement( 'li' );
+          li.appendChild( a );
+          ul.appendChild( li );
+        } );
+        toc.appendChild( ul );
+      } );
+    } );
+  } );
+} );
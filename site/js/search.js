@@ -0,0 +1,119 @@
+// Search box of the navigation bar, over the index written by search.py.
+// Only the index and the shards matching the typed name are downloaded, once each.
+(function() {
+  var index = null;
+  var shards = {};
+
+  function loadIndex() {
+    if ( index === null ) {
+      index = fetch( '/search/index.json' ).then( function( r ) { return r.json(); } );
+    }
+    return index;
+  }
+
+  function loadShard( prefix ) {
+    if ( !( prefix in shards ) ) {
+      shards[prefix] = fetch( '/search/shards/' + prefix + '.json' ).then( function( r ) { return r.json(); } );
+    }
+    return shards[prefix];
+  }
+
+  // Same as name_prefix() in search.py.
+  function namePrefix( name ) {
+    return name.toLowerCase().replace( /[^a-z0-9]/g, '_' );
+  }
+
+  function lastName( qualified ) {
+    var i = qualified.lastIndexOf( '::' );
+    return i < 0 ? qualified : qualified.substring( i + 2 );
+  }
+
+  // Symbols whose name starts with the last component of the query, and whose scope
+  // contains the other components ( "ns::cl" finds "Namespace::Class" ).
+  function search( query ) {
+    var scopes = query.trim().toLowerCase().split( '::' );
+    var name = scopes.pop();
+    var prefix = namePrefix( name );
+    if ( prefix.length === 0 ) {
+      return Promise.resolve( null );
+    }
+    return loadIndex().then( function( idx ) {
+      var wanted = idx.shards.filter( function( p ) { return prefix.startsWith( p ) || p.startsWith( prefix ); } );
+      if ( wanted.length > 16 ) {
+        return null;
+      }
+      return Promise.all( wanted.map( loadShard ) ).then( function( lists ) {
+        var result = [];
+        lists.forEach( function( entries ) {
+          entries.forEach( function( e ) {
+            var qualified = e[0].toLowerCase();
+            var scope = qualified.substring( 0, qualified.length - lastName( qualified ).length );
+            if ( lastName( qualified ).startsWith( name ) && scopes.every( function( s ) { return scope.includes( s ); } ) ) {
+              result.push( { name: e[0], kind: idx.kinds[e[1]], link: e[2], brief: e[3] } );
+            }
+          } );
+        } );
+        result.sort( function( a, b ) { return a.name.length - b.name.length || a.name.localeCompare( b.name ); } );
+        return result.slice( 0, 50 );
+      } );
+    } );
+  }
+
+  function show( list, results ) {
+    list.innerHTML = '';
+    if ( results === null ) {
+      list.classList.remove( 'show' );
+      return;
+    }
+    if ( results.length === 0 ) {
+      results = [ { name: 'No match', kind: '', link: null, brief: '' } ];
+    }
+    results.forEach( function( r ) {
+      var item = document.createElement( r.link ? 'a' : 'span' );
+      item.className = 'dropdown-item';
+      if ( r.link ) {
+        item.href = r.link;
+      }
+      var title = document.createElement( 'span' );
+      title.textContent = r.name;
+      item.appendChild( title );
+      var kind = document.createElement( 'small' );
+      kind.className = 'text-muted ms-2';
+      kind.textContent = r.kind;
+      item.appendChild( kind );
+      if ( r.brief ) {
+        var brief = document.createElement( 'div' );
+        brief.className = 'small text-muted text-truncate';
+        brief.textContent = r.brief;
+        item.appendChild( brief );
+      }
+      var li = document.createElement( 'li' );
+      li.appendChild( item );
+      list.appendChild( li );
+    } );
+    list.classList.add( 'show' );
+  }
+
+  document.addEventListener( 'DOMContentLoaded', function() {
+    var input = document.getElementById( 'search' );
+    var list = document.getElementById( 'search-results' );
+    if ( !input || !list ) {
+      return;
+    }
+    var pending = 0;
+    input.addEventListener( 'input', function() {
+      var current = ++pending;
+      search( input.value ).then( function( results ) {
+        if ( current === pending ) {
+          show( list, results );
+        }
+      } );
+    } );
+    input.addEventListener( 'keydown', function( e ) {
+      if ( e.key === 'Escape' ) {
+        input.value = '';
+        show( list, null );
+      }
+    } );
+  } );
+})();